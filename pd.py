@@ -18,9 +18,9 @@
 ## along with this program; if not, see <http://www.gnu.org/licenses/>.
 ##
 
-import re
+import sys
 import sigrokdecode as srd
-from common.srdhelper import bcd2int, SrdIntEnum
+from functools import lru_cache
 
 REGs = {
  0x06: ('BCD_TYPEC_REV_LOW', None),
@@ -101,6 +101,77 @@ REGs = {
  0x94: ('RDO_REG_STATUS_3', None),
 }
 
+# Annotation class indices (see Decoder.annotations below).
+ANN_ADDRESS, ANN_REGISTER, ANN_WARNING, ANN_ERROR = range(4)
+
+# Decoder states, as small ints so the state machine compares ints
+# rather than whole strings on every packet.
+S_IDLE, S_GET_ADDR, S_GET_REG, S_WRITE, S_READ = range(5)
+
+# Integer codes for the I2C protocol commands handed to decode().
+(CMD_BITS, CMD_START, CMD_START_REPEAT, CMD_STOP, CMD_ACK, CMD_NACK,
+ CMD_ADDRESS_READ, CMD_ADDRESS_WRITE, CMD_DATA_READ, CMD_DATA_WRITE) = range(10)
+
+_CMD_MAP = {
+    'BITS': CMD_BITS,
+    'START': CMD_START,
+    'START REPEAT': CMD_START_REPEAT,
+    'STOP': CMD_STOP,
+    'ACK': CMD_ACK,
+    'NACK': CMD_NACK,
+    'ADDRESS READ': CMD_ADDRESS_READ,
+    'ADDRESS WRITE': CMD_ADDRESS_WRITE,
+    'DATA READ': CMD_DATA_READ,
+    'DATA WRITE': CMD_DATA_WRITE,
+}
+# Intern the command names, so the map lookup (and the BITS identity
+# check in decode) hits the pointer-compare fast path.
+_CMD_MAP = {sys.intern(_k): _v for _k, _v in _CMD_MAP.items()}
+_BITS = sys.intern('BITS')
+
+# Reverse map, only needed when building annotation text.
+_CMD_NAME = {v: k for k, v in _CMD_MAP.items()}
+
+# Fixed annotation payloads, built once instead of per packet.
+_ANN_EXPECT_RW = [ANN_ERROR, ['Expected READ/WRITE']]
+_ANN_UNEXPECTED_ACK = [ANN_ERROR, ['Unxpected ACK']]
+_ANN_EXPECT_DW_STOP = [ANN_ERROR, ['Expected DATA WRITE or STOP', 'ERR']]
+_ANN_EXPECT_DR_STOP = [ANN_ERROR, ['Expected DATA READ or STOP', 'ERR']]
+
+# The register-select error names the offending command; cache one
+# payload per command instead of concatenating strings per packet.
+_ERR_EXPECT_DW = {cmd_id: [ANN_ERROR, ['Expected DATA WRITE (got %s)' % name, 'ERR']]
+                  for cmd_id, name in _CMD_NAME.items()}
+_ERR_EXPECT_DW_UNK = [ANN_ERROR, ['Expected DATA WRITE (got ?)', 'ERR']]
+
+# Register names and annotation payloads as flat 256-entry tables
+# indexed by the register byte; a single indexed load replaces the
+# dict hash-and-probe, with None marking the holes.
+_REG_NAMES = [None] * 256
+for _reg, (_name, _) in REGs.items():
+    _REG_NAMES[_reg] = _name
+
+_WRITE_ANNS = tuple([ANN_REGISTER, ['Write ' + name, name]] if name else None
+                    for name in _REG_NAMES)
+_READ_ANNS = tuple([ANN_REGISTER, ['Read ' + name, name]] if name else None
+                   for name in _REG_NAMES)
+_SETREG_ANNS = tuple([ANN_REGISTER, ['Register ' + name, name]] if name else None
+                     for name in _REG_NAMES)
+
+# Unknown-register payloads are memoized per register value, so the
+# %02X formatting only runs once per distinct byte.
+@lru_cache(maxsize=256)
+def _unk_write(reg):
+    return [ANN_REGISTER, ['Write Unknown reg %02X' % reg, 'Unknown']]
+
+@lru_cache(maxsize=256)
+def _unk_read(reg):
+    return [ANN_REGISTER, ['Read Unknown reg %02X' % reg, 'Unknown']]
+
+@lru_cache(maxsize=256)
+def _unk_setreg(reg):
+    return [ANN_REGISTER, ['Unknown Register %02X' % reg]]
+
 class Decoder(srd.Decoder):
     api_version = 3
     id = 'stusb4500'
@@ -124,11 +195,6 @@ class Decoder(srd.Decoder):
         ('errors', 'Errors', (3,))
     )
 
-    ANN_ADDRESS = 0
-    ANN_REGISTER = 1
-    ANN_WARNING = 2
-    ANN_ERROR = 3
-
     options = (
         {'id': 'address', 'desc': 'I2C Address', 'default': '0x28', 'values': ('0x28', '0x29', '0x2A', '0x2B')},
     )
@@ -137,161 +203,175 @@ class Decoder(srd.Decoder):
         self.reset()
 
     def reset(self):
-        self.state = 'IDLE'
+        self.state = S_IDLE
         self.reg = None
         self.write = None
-        self.bits = []
 
     def start(self):
         self.out_ann = self.register(srd.OUTPUT_ANN)
-        self.address = {'0x28':0x28, '0x29':0x29, '0x2A':0x2A, '0x2B':0x2B}[self.options['address']]
+        try:
+            self.address = int(self.options['address'], 16)
+        except ValueError:
+            self.address = 0x28
+        # Cache the bound put method and annotation output id; the hot
+        # path then avoids re-resolving these attributes per emission.
+        self._put = self.put
+        self._ann = self.out_ann
+        # Per-state handlers, indexed by the integer state constants.
+        self._handlers = (self._idle, self._get_addr, self._get_reg,
+                          self._write, self._read)
+        # Dispatch for the rare per-transaction commands; the hot data
+        # and ACK packets stay on the ordered ladder in the handlers.
+        self._write_tail = {CMD_STOP: self._to_idle,
+                            CMD_START_REPEAT: self._restart}
+        self._read_tail = {CMD_NACK: self._nack,
+                           CMD_STOP: self._to_idle}
+        # Address annotations, precomputed for all 128 possible slave
+        # addresses so the hot path never formats a string.
+        self._addr_match = [ANN_ADDRESS, ['Address (slave 0x%02X)' % self.address]]
+        self._addr_bad = tuple([ANN_ADDRESS, ['Ignoring wrong addr (slave 0x%02X)' % i]]
+                               for i in range(128))
 
-    def putx(self, data):
-        self.put(self.ss, self.es, self.out_ann, data)
+    def putx(self, ss, es, data):
+        self._put(ss, es, self._ann, data)
 
-    def putd(self, bit1, bit2, data):
-        self.put(self.bits[bit1][1], self.bits[bit2][2], self.out_ann, data)
-    
     #def putr(self, bit):
     #    self.put(self.bits[bit][1], self.bits[bit][2], self.out_ann,
     #             [Ann.BIT_RESERVED, ['Reserved bit', 'Reserved', 'Rsvd', 'R']])
 
-    def handle_write_reg(self, b):
-        if self.reg in REGs:
-            name = REGs[self.reg][0]
-            self.putx([self.ANN_REGISTER, ['Write '+name, name]])
-        else:
-            self.putx([self.ANN_REGISTER, ['Write Unknown reg %02X'%self.reg, "Unknown"]])
-        #fn = getattr(self, 'handle_reg_0x%02x' % r)
-        #fn(b)
-        self.reg += 1
-
-    def handle_read_reg(self, b):
-        if self.reg in REGs:
-            name = REGs[self.reg][0]
-            self.putx([self.ANN_REGISTER, ['Read '+name, name]])
-        else:
-            self.putx([self.ANN_REGISTER, ['Read Unknown reg %02X'%self.reg, "Unknown"]])
-        #fn = getattr(self, 'handle_reg_0x%02x' % r)
-        #fn(b)
-        self.reg += 1
-
-    def handle_ACK(self):
-        if self.needACK == True:
-            #self.putx([self.ANN_ERROR, ['ACK Handled']])
-            self.needACK = False
-            return True
-        else:
-            self.putx([self.ANN_ERROR, ['Unxpected ACK']])
-            return False
-
-    def is_correct_chip(self, addr):
+    def is_correct_chip(self, addr, es):
         addr = addr >> 1
         if addr == self.address:
-            self.put(self.ss_block, self.es, self.out_ann, [self.ANN_ADDRESS, ['Address (slave 0x%02X)' % addr]])
+            self._put(self.ss_block, es, self._ann, self._addr_match)
             return True
         else:
-            self.put(self.ss_block, self.es, self.out_ann, [self.ANN_ADDRESS, ['Ignoring wrong addr (slave 0x%02X)' % addr]])
+            self._put(self.ss_block, es, self._ann, self._addr_bad[addr])
             return False
 
-    def setReg(self, reg):
-        self.reg = reg
-        if self.reg in REGs:
-            name = REGs[self.reg][0]
-            self.putx([self.ANN_REGISTER, ["Register "+name, name]])
-        else:
-            self.putx([self.ANN_REGISTER, ["Unknown Register %02X"%self.reg]])
+    def _to_idle(self, ss, es):
+        self.state = S_IDLE
 
-    def decode(self, ss, es, data):
-        cmd, databyte = data
+    def _restart(self, ss, es):
+        self.state = S_GET_ADDR
+        self.ss_block = ss
+
+    def _nack(self, ss, es):
+        self.state = S_IDLE
+        self.needACK = False
+
+    def _err_write(self, ss, es):
+        self.putx(ss, es, _ANN_EXPECT_DW_STOP)
 
-        # Collect the 'BITS' packet, then return. The next packet is
-        # guaranteed to belong to these bits we just stored.
-        if cmd == 'BITS':
-            self.bits = databyte
+    def _err_read(self, ss, es):
+        self.putx(ss, es, _ANN_EXPECT_DR_STOP)
+
+    def _idle(self, cmd_id, databyte, ss, es):
+        # Wait for an I²C START condition.
+        if cmd_id != CMD_START:
+            return
+        # Now wait to confirm what the slave address is
+        self.state = S_GET_ADDR
+        self.ss_block = ss
+
+    def _get_addr(self, cmd_id, databyte, ss, es):
+        # Here we verify the correct I2C address is being targetted
+        if (cmd_id != CMD_ADDRESS_WRITE) and (cmd_id != CMD_ADDRESS_READ):
+            #Some error here, restart back to the idle state
+            self.putx(ss, es, _ANN_EXPECT_RW)
+            self.state = S_IDLE
             return
 
-        # Store the start/end samples of this IÂ²C packet.
-        self.ss, self.es = ss, es
-
-        # State machine.
-        if self.state == 'IDLE':
-            # Wait for an I²C START condition.
-            if cmd != 'START':
-                return
-            # Now wait to confirm what the slave address is
-            self.state = 'GET SLAVE ADDR'
-            self.ss_block = ss
-        elif self.state == 'GET SLAVE ADDR':
-            # Here we verify the correct I2C address is being targetted
-            if (cmd != 'ADDRESS WRITE') and (cmd != 'ADDRESS READ'):
-                #Some error here, restart back to the idle state
-                self.putx([self.ANN_ERROR, ['Expected READ/WRITE']])
-                self.state = 'IDLE'
-                return
-            
-            if not self.is_correct_chip(databyte):
-                #This is not the correct I2C address, so reset the state machine
-                self.state = 'IDLE'
-                return
+        if not self.is_correct_chip(databyte, es):
+            #This is not the correct I2C address, so reset the state machine
+            self.state = S_IDLE
+            return
+
+        self.needACK = True
+        if cmd_id == CMD_ADDRESS_WRITE:
+            #Now if we're writing, then this first byte is the address
+            self.state = S_GET_REG
+        else:
+            #If we're reading, then we're loading reg data
+            self.state = S_READ
 
+    def _get_reg(self, cmd_id, databyte, ss, es):
+        # Wait for a data write (master selects the slave register).
+        if cmd_id == CMD_DATA_WRITE:
+            #The data byte is the register we're now addressing
+            self.reg = databyte
+            ann = _SETREG_ANNS[databyte]
+            if ann is None:
+                ann = _unk_setreg(databyte)
+            self.putx(ss, es, ann)
+            self.state = S_WRITE
             self.needACK = True
-            if cmd == 'ADDRESS WRITE':
-                #Now if we're writing, then this first byte is the address
-                self.state = 'GET REG ADDR'
+        elif cmd_id == CMD_ACK:
+            if self.needACK:
+                self.needACK = False
             else:
-                #If we're reading, then we're loading reg data
-                self.state = 'READ REGS'
-        elif self.state == 'GET REG ADDR':
-            # Wait for a data write (master selects the slave register).
-            if cmd == "ACK":
-                if self.handle_ACK():
-                    return
-                else:
-                    self.state = "IDLE"
-                    return
-
-            if cmd != 'DATA WRITE':
-                self.putx([self.ANN_ERROR, ['Expected DATA WRITE (got '+cmd+')', 'ERR']])
-                self.state = 'IDLE'
-                return
-            #The data byte is the register we're now addressing
-            self.setReg(databyte)
-            self.state = 'WRITE REGS'
+                self.putx(ss, es, _ANN_UNEXPECTED_ACK)
+                self.state = S_IDLE
+        else:
+            self.putx(ss, es, _ERR_EXPECT_DW.get(cmd_id, _ERR_EXPECT_DW_UNK))
+            self.state = S_IDLE
+
+    def _write(self, cmd_id, databyte, ss, es):
+        # Ordered by observed frequency: data bytes first, their ACKs
+        # second, the per-transaction delimiters last.
+        if cmd_id == CMD_DATA_WRITE:
+            reg = self.reg
+            ann = _WRITE_ANNS[reg]
+            if ann is None:
+                ann = _unk_write(reg)
+            self.putx(ss, es, ann)
+            #fn = getattr(self, 'handle_reg_0x%02x' % reg)
+            #fn(databyte)
+            self.reg = (reg + 1) & 0xFF
             self.needACK = True
-        elif self.state == 'WRITE REGS':
-            if cmd == "ACK":
-                if self.handle_ACK():
-                    return
-                else:
-                    self.state = "IDLE"
-                    return
-
-            if cmd == 'DATA WRITE':
-                self.handle_write_reg(databyte)
-                self.needACK = True
-            elif cmd == 'STOP':
-                self.state = 'IDLE'
-            elif cmd == "START REPEAT":
-                self.state = 'GET SLAVE ADDR'
-                self.ss_block = ss
+        elif cmd_id == CMD_ACK:
+            if self.needACK:
+                self.needACK = False
             else:
-                self.putx([self.ANN_ERROR, ['Expected DATA WRITE or STOP', 'ERR']])
-        elif self.state == 'READ REGS':
-            if cmd == "ACK":
-                if self.handle_ACK():
-                    return
-                else:
-                    self.state = "IDLE"
-                    return
-            
-            if cmd == 'NACK':
-                self.state = 'IDLE'
+                self.putx(ss, es, _ANN_UNEXPECTED_ACK)
+                self.state = S_IDLE
+        else:
+            self._write_tail.get(cmd_id, self._err_write)(ss, es)
+
+    def _read(self, cmd_id, databyte, ss, es):
+        # Same frequency ordering as _write.
+        if cmd_id == CMD_DATA_READ:
+            reg = self.reg
+            ann = _READ_ANNS[reg]
+            if ann is None:
+                ann = _unk_read(reg)
+            self.putx(ss, es, ann)
+            #fn = getattr(self, 'handle_reg_0x%02x' % reg)
+            #fn(databyte)
+            self.reg = (reg + 1) & 0xFF
+            self.needACK = True
+        elif cmd_id == CMD_ACK:
+            if self.needACK:
                 self.needACK = False
-            elif cmd == 'DATA READ':
-                self.handle_read_reg(databyte)
-                self.needACK = True
-            elif cmd == 'STOP':
-                self.state = 'IDLE'
             else:
-                self.putx([self.ANN_ERROR, ['Expected DATA READ or STOP', 'ERR']])
+                self.putx(ss, es, _ANN_UNEXPECTED_ACK)
+                self.state = S_IDLE
+        else:
+            self._read_tail.get(cmd_id, self._err_read)(ss, es)
+
+    def decode(self, ss, es, data):
+        cmd, databyte = data
+
+        # Skip 'BITS' packets; nothing here annotates individual bits,
+        # so there is no point retaining them. An identity check
+        # suffices for the interned literal the i2c PD hands us; the
+        # map below still catches an equal non-interned string.
+        if cmd is _BITS:
+            return
+
+        cmd_id = _CMD_MAP.get(cmd, -1)
+        if cmd_id == CMD_BITS:
+            return
+
+        # Dispatch to the handler for the current state; the packet's
+        # sample range travels as plain locals, never via the instance.
+        self._handlers[self.state](cmd_id, databyte, ss, es)